@@ -12,11 +12,14 @@ from aiida import orm
 from aiida.cmdline.utils import decorators
 from aiida.common import NotExistent
 from aiida.manage import get_manager
+from aiida.storage.psql_dos.models.node import DbNode
 from hith.data import flags
 from pymatgen.analysis.structure_matcher import StructureMatcher
 from rich import print
 from rich.pretty import pprint
 from rich.progress import track
+from sqlalchemy import bindparam, update
+from sqlalchemy.dialects.postgresql import JSONB
 
 app = typer.Typer(pretty_exceptions_show_locals=False)
 
@@ -49,6 +52,18 @@ def uniq(
     sort_by_spg: bool = True,
     matcher_settings: Path = None,
     limit: int = None,
+    parallelize: Annotated[
+        Optional[int],
+        typer.Option(
+            help="Number of processes over which to distribute the symmetry and uniqueness analysis.",
+        ),
+    ] = None,
+    symmetry_backend: Annotated[
+        str,
+        typer.Option(
+            help="Library used to determine the space group when sorting: `spglib` or `moyopy`.",
+        ),
+    ] = "spglib",
 ):
     """Perform uniqueness analysis on a group of structures.
 
@@ -57,12 +72,28 @@ def uniq(
     structures in the sorted list to each other using the `StructureMatcher` from pymatgen.
     """
     from .uniq import (
+        SYMMETRY_BACKENDS,
         first_come_first_serve,
-        get_spglib_spacegroup_symbol,
+        get_spacegroup_numbers,
+        get_spglib_cell,
+        moyopy,
         pymatgen_group,
         seb_knows_best,
     )
 
+    if symmetry_backend not in SYMMETRY_BACKENDS:
+        print(
+            f"[bold red]Error:[/] Unknown symmetry backend `{symmetry_backend}`, choose from: {SYMMETRY_BACKENDS}."
+        )
+        return
+
+    if symmetry_backend == "moyopy" and moyopy is None:
+        print(
+            "[bold red]Error:[/] The `moyopy` symmetry backend is not installed. Install it with "
+            "`pip install mc3d-source[moyopy]`."
+        )
+        return
+
     method_mapping = {
         "seb": seb_knows_best,
         "first": first_come_first_serve,
@@ -160,6 +191,11 @@ def uniq(
         print(f"[bold blue]Info:[/] Limiting the source query to {limit} structures.")
         query_dict["source"].limit(limit)
 
+    if sort_by_spg:
+        print(
+            f"[bold blue]Info:[/] Using `{symmetry_backend}` to determine the space groups."
+        )
+
     if number_target != 0:
         print(
             f"[bold blue]Info:[/] Found {number_target} structures in the target group."
@@ -169,30 +205,47 @@ def uniq(
     mapping = collections.defaultdict(list)
 
     for group, query in query_dict.items():
+        entries = []
+
         for [structure] in track(
-            query.iterall(),
+            query.iterall(batch_size=1000),
             total=query.count(),
             description=f"Sorting {group} group:" + " " * 9,
         ):
             try:
                 sort_key = structure.get_formula(mode="hill_compact")
+                cell = get_spglib_cell(structure) if sort_by_spg else None
+            except Exception as exc:
+                failures.append((structure.uuid, exc))
+                continue
+
+            entries.append((sort_key, structure, cell))
+
+        if sort_by_spg:
+            # The symmetry analysis is the expensive part of the sorting, so it is distributed over the processes
+            numbers = get_spacegroup_numbers(
+                [cell for *_, cell in entries],
+                symprec=0.005,
+                backend=symmetry_backend,
+                parallelize=parallelize,
+                description=f"Symmetry {group} group:" + " " * 8,
+            )
+        else:
+            numbers = [None] * len(entries)
 
-                if sort_by_spg:
-                    sort_key += "|"
-                    sort_key += str(
-                        get_spglib_spacegroup_symbol(structure, symprec=0.005)
-                    )
+        for number, (sort_key, structure, _) in zip(numbers, entries):
+            if isinstance(number, Exception):
+                failures.append((structure.uuid, number))
+                continue
 
-                if group == "target" and sort_key not in mapping.keys():
-                    # If the `target` key is not in the list of `source` keys, it doesn't need to be considered
-                    continue
+            if sort_by_spg:
+                sort_key += f"|{number}"
 
-                mapping[sort_key].append(
-                    [len(structure.sites), structure.uuid, structure]
-                )
+            if group == "target" and sort_key not in mapping.keys():
+                # If the `target` key is not in the list of `source` keys, it doesn't need to be considered
+                continue
 
-            except Exception as exc:
-                failures.append((structure.uuid, exc))
+            mapping[sort_key].append([len(structure.sites), structure.uuid, structure])
 
     if failures:
         print("[bold yellow]Warning:[/] Some structures failed to be sorted:")
@@ -213,60 +266,90 @@ def uniq(
     #     yaml.dump(sort_number_dict, handle)
 
     # Perform the uniqueness analysis with the chosen method
-    uniq = method_mapping[method](ordered, matcher)
+    uniq = method_mapping[method](ordered, matcher, parallelize)
 
     # with Path(f'results-{timestamp}.yaml').open('w') as handle:
     #     yaml.dump({puuid: data[1] for puuid, data in uniq.items()}, handle)
 
     new_uuid_uniq = uniq.copy()
 
+    # All duplicates are among the sorted structures, so there is no need to load them from the database again
+    uuid_to_structure = {
+        uuid: structure for entries in ordered.values() for uuid, structure in entries
+    }
+
     duplicate_style = "source"
 
     def get_duplicate_id(node, style="source"):
         if style == "source":
-            duplicate_id = list(node.extras["source"].values())
-            duplicate_id.reverse()
-            return "|".join(duplicate_id)
+            source = node.extras["source"]
+            return "|".join((source["database"], source["version"], source["id"]))
         if style == "uuid":
             return node.uuid
 
     def get_duplicate_set(uuid, style="source"):
-        duplicates = orm.load_node(uuid).extras.get("duplicates", [])
+        duplicates = uuid_to_structure[uuid].extras.get("duplicates", [])
         duplicates = [] if isinstance(duplicates, dict) else duplicates
         return set(
             [
-                get_duplicate_id(orm.load_node(uuid), style),
+                get_duplicate_id(uuid_to_structure[uuid], style),
             ]
             + duplicates
         )
 
     target_duplicates_list = []
 
+    # Map each UUID on the UUID of its family, so finding the family of a target node is a single lookup
+    uuid_to_family = {
+        uuid: uniq_uuid
+        for uniq_uuid, (_, duplicate_uuids) in uniq.items()
+        for uuid in duplicate_uuids
+    }
+
     # Add the duplicates to the target group nodes
     if target_group.nodes:
         for structure in track(
             target_group.nodes, description="Looking for new unique nodes: "
         ):
-            for uniq_uuid, data in uniq.items():
-                _, duplicate_uuids = data
+            uniq_uuid = uuid_to_family.get(structure.uuid)
+
+            if uniq_uuid is None:
+                continue
 
-                if structure.uuid in data[1]:
-                    new_uuid_uniq.pop(uniq_uuid, None)
+            _, duplicate_uuids = uniq[uniq_uuid]
+            new_uuid_uniq.pop(uniq_uuid, None)
 
-                    if not dry_run:
-                        target_duplicates = set(structure.extras["duplicates"])
-                        for duplicate_uuid in duplicate_uuids:
-                            target_duplicates.update(
-                                get_duplicate_set(duplicate_uuid, duplicate_style)
-                            )
-                        target_duplicates_list.append((structure, target_duplicates))
+            if not dry_run:
+                target_duplicates = set(structure.extras["duplicates"])
+                for duplicate_uuid in duplicate_uuids:
+                    target_duplicates.update(
+                        get_duplicate_set(duplicate_uuid, duplicate_style)
+                    )
+                target_duplicates_list.append((structure, target_duplicates))
+
+    def get_extras_row(node, duplicates):
+        return {"node_id": node.pk, "extras": {"duplicates": sorted(duplicates)}}
+
+    # Merge the `duplicates` into the extras in the database, so the other extras are left untouched
+    db_node = DbNode.__table__
+    update_duplicates = (
+        update(db_node)
+        .where(db_node.c.id == bindparam("node_id"))
+        .values(extras=db_node.c.extras.op("||")(bindparam("extras", type_=JSONB)))
+    )
+    storage = get_manager().get_profile_storage()
 
     if not dry_run and target_group.nodes:
+        extras_rows = []
         for structure, duplicates in track(
             target_duplicates_list, description="Updating target duplicates:   "
         ):
             duplicates.remove(get_duplicate_id(structure))
-            structure.base.extras.set("duplicates", duplicates)
+            extras_rows.append(get_extras_row(structure, duplicates))
+
+        if extras_rows:
+            with storage.transaction() as session:
+                session.execute(update_duplicates, extras_rows)
 
     print(f"[bold blue]Info:[/] Found {len(new_uuid_uniq)} new unique structures.")
 
@@ -277,23 +360,27 @@ def uniq(
 
     if not dry_run and len(new_uuid_uniq) > 0:
         # Add the new golden structures + duplicates to the target group
-        with get_manager().get_profile_storage().transaction() as _:
-            for data in track(
-                new_uuid_uniq.values(), description="Adding extras to new nodes:   "
-            ):
-                structure, duplicates = data
-                try:
-                    target_duplicates = set(structure.extras.get("duplicates", []))
-                except TypeError:
-                    raise ValueError(structure.extras.get("duplicates", []))
-                if duplicate_style == "source":
-                    duplicates = [
-                        get_duplicate_id(orm.load_node(uuid)) for uuid in duplicates
-                    ]
-                target_duplicates.update(set(duplicates))
-                target_duplicates.remove(get_duplicate_id(structure))
-                structure.base.extras.set("duplicates", target_duplicates)
-                new_nodes.append(structure)
+        extras_rows = []
+        for data in track(
+            new_uuid_uniq.values(), description="Adding extras to new nodes:   "
+        ):
+            structure, duplicates = data
+            try:
+                target_duplicates = set(structure.extras.get("duplicates", []))
+            except TypeError:
+                raise ValueError(structure.extras.get("duplicates", []))
+            if duplicate_style == "source":
+                duplicates = [
+                    get_duplicate_id(uuid_to_structure[uuid]) for uuid in duplicates
+                ]
+            target_duplicates.update(set(duplicates))
+            target_duplicates.remove(get_duplicate_id(structure))
+            extras_rows.append(get_extras_row(structure, target_duplicates))
+            new_nodes.append(structure)
+
+        if extras_rows:
+            with storage.transaction() as session:
+                session.execute(update_duplicates, extras_rows)
 
     print(f"[bold blue]Info:[/] Adding {len(new_nodes)} nodes to target group.")
     target_group.backend_entity.add_nodes(
@@ -319,29 +406,44 @@ def select(unique_group):
     duplicate that doesn't have any problematic flags, preferring those from the COD, then the ICSD,
     then the MPDS. This is based on the permissiveness of the licenses of these databases.
     """
-    from .select import find_better_duplicates, replace_structure
+    from .select import (
+        choose_replacement,
+        find_better_duplicates,
+        find_source_structures,
+        find_structures,
+        get_flag_sets,
+        replace_structure,
+    )
 
-    flag_dict = {}
+    flag_ids = {}
+    problematic_ids = {}
 
     print(
         "[bold blue]Info[/]: Populating flag dictionary from the CSV files of each database."
     )
     for database in ("cod", "icsd", "mpds"):
-        flag_dict.setdefault(database, {})
         df = pd.read_csv(resources.files(flags) / f"{database}.csv", header=2)
-        for _, row in track(df.iterrows(), description=database.upper()):
-            flag_dict[database][str(row["id"])] = row
+        flag_ids[database], problematic_ids[database] = get_flag_sets(df)
 
     replacements = []
 
-    for structure in track(
-        orm.load_group("global/uniq").nodes,
+    # Only project the extras, the structures are loaded only for the ones that are replaced
+    query = orm.QueryBuilder()
+    query.append(orm.Group, filters={"label": "global/uniq"}, tag="group").append(
+        orm.StructureData,
+        with_group="group",
+        filters={"extras": {"has_key": "duplicates"}},
+        project=("id", "extras"),
+    )
+
+    for pk, extras in track(
+        query.iterall(batch_size=1000),
+        total=query.count(),
         description="Checking for better duplicates",
     ):
-        if "duplicates" in structure.extras:
-            better_duplicates = find_better_duplicates(flag_dict, structure)
-            if better_duplicates:
-                replacements.append((structure, better_duplicates))
+        better_duplicates = find_better_duplicates(flag_ids, problematic_ids, extras)
+        if better_duplicates:
+            replacements.append((pk, better_duplicates))
 
     print(
         f"[bold blue]Info[/]:Found {len(replacements)} structures to replace with better duplicates."
@@ -350,5 +452,32 @@ def select(unique_group):
 
     group = orm.load_group(unique_group)
 
-    for replacement in track(replacements, description="Replacing structures"):
-        replace_structure(replacement, group)
+    chosen_replacements = [
+        (pk, choose_replacement(better_duplicates))
+        for pk, better_duplicates in replacements
+    ]
+    # Look up the original and replacement structures in batches
+    replacement_structures = find_source_structures(
+        [source for _, source in chosen_replacements]
+    )
+    structures = find_structures([pk for pk, _ in chosen_replacements])
+
+    # Commit all extras changes and group updates in a single transaction
+    with get_manager().get_profile_storage().transaction() as _:
+        for pk, source in track(
+            chosen_replacements, description="Replacing structures"
+        ):
+            replace_structure(structures[pk], replacement_structures[source])
+
+        # Update the group memberships of all replaced structures together
+        group.backend_entity.add_nodes(
+            [
+                replacement_structures[source].backend_entity
+                for _, source in chosen_replacements
+            ],
+            skip_orm=True,
+        )
+        group.backend_entity.remove_nodes(
+            [structures[pk].backend_entity for pk, _ in chosen_replacements],
+            skip_orm=True,
+        )
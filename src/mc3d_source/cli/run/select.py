@@ -3,74 +3,109 @@
 # pylint: disable=redefined-builtin, unsubscriptable-object
 from __future__ import annotations
 
+import collections
+
 from aiida import orm
 
 
-def find_better_duplicates(flag_dict, structure):
-    """Find better duplicates for a structure, if any."""
+PROBLEMATIC_FLAGS = ["is_theoretical", "is_high_pressure", "is_high_temperature"]
+
 
-    def get_ok_duplicates(structure, bad_flags):
-        duplicate_list = []
+def get_flag_sets(flag_df):
+    """Get the set of all IDs and the set of IDs with problematic (or missing) flags from the flags of a database."""
+    ids = flag_df["id"].astype(str)
+    problematic = flag_df[PROBLEMATIC_FLAGS].fillna(True).astype(bool).any(axis=1)
 
-        for duplicate in structure.extras["duplicates"]:
-            duplicate_db, _, duplicate_id = duplicate.split("|")
-            try:
-                data = flag_dict[duplicate_db][duplicate_id]
-                if all(not bad for bad in [data[flag] for flag in bad_flags]):
-                    duplicate_list.append(f"{duplicate_db}|{duplicate_id}")
-            except KeyError:
-                pass
+    return frozenset(ids), frozenset(ids[problematic])
 
-        return duplicate_list
 
-    source_db = structure.extras["source"]["database"]
-    source_id = structure.extras["source"]["id"]
+def find_better_duplicates(flag_ids, problematic_ids, extras):
+    """Find better duplicates for a structure based on its extras and the flag IDs of each database, if any."""
+    source_db = extras["source"]["database"]
+    source_id = extras["source"]["id"]
 
-    try:
-        struc_df = flag_dict[source_db][source_id]
-    except KeyError:
+    if source_db not in flag_ids or source_id not in problematic_ids[source_db]:
         return
 
-    if any(
-        (
-            struc_df["is_theoretical"],
-            struc_df["is_high_pressure"],
-            struc_df["is_high_temperature"],
-        )
-    ):
-        better_duplicates = get_ok_duplicates(
-            structure, ["is_theoretical", "is_high_pressure", "is_high_temperature"]
-        )
-        if better_duplicates:
-            return better_duplicates
+    better_duplicates = []
+
+    for duplicate in extras["duplicates"]:
+        duplicate_db, _, duplicate_id = duplicate.split("|")
+
+        if duplicate_db not in flag_ids:
+            continue
+
+        if (
+            duplicate_id in flag_ids[duplicate_db]
+            and duplicate_id not in problematic_ids[duplicate_db]
+        ):
+            better_duplicates.append(f"{duplicate_db}|{duplicate_id}")
+
+    if better_duplicates:
+        return better_duplicates
+
+
+def choose_replacement(better_duplicates):
+    """Choose the duplicate to replace a structure with from its better duplicates.
+
+    Prefer the databases with the most permissive licenses, and the first duplicate for each database.
+    """
+    priority = {"cod": 0, "icsd": 1, "mpds": 2}
+    return min(
+        better_duplicates, key=lambda duplicate: priority[duplicate.split("|")[0]]
+    )
 
 
-def replace_structure(replacement, unique_group):
-    """Replace a structure with a better duplicate in the `unique_group` group."""
+def find_source_structures(sources, batch_size=1000):
+    """Find the structures for a list of `database|id` sources, querying the IDs of each database in batches.
 
-    structure, better_duplicates = replacement
+    Returns a dictionary that maps each source on its structure.
+    """
+    ids_per_database = collections.defaultdict(list)
 
-    chosen_replacement = None
+    for source in sources:
+        database, source_id = source.split("|")
+        ids_per_database[database].append(source_id)
 
-    for database in ["cod", "icsd", "mpds"]:
-        for duplicate in better_duplicates:
-            if duplicate.startswith(database) and chosen_replacement is None:
-                chosen_replacement = duplicate
+    source_structures = {}
 
-    replacement_db, replacement_id = chosen_replacement.split("|")
+    for database, source_ids in ids_per_database.items():
+        for start in range(0, len(source_ids), batch_size):
+            batch = source_ids[start : start + batch_size]
+            query = orm.QueryBuilder().append(
+                orm.StructureData,
+                filters={
+                    "extras.source.database": database,
+                    "extras.source.id": {"in": batch},
+                },
+                project=("extras.source.id", "*"),
+            )
+            for source_id, structure in query.iterall():
+                source_structures.setdefault(f"{database}|{source_id}", structure)
 
-    query = orm.QueryBuilder()
+    return source_structures
 
-    replacement_structure = query.append(
-        orm.StructureData,
-        filters={
-            "and": [
-                {"extras.source.database": replacement_db},
-                {"extras.source.id": replacement_id},
-            ]
-        },
-    ).first()[0]
 
+def find_structures(pks, batch_size=1000):
+    """Find the structures for a list of `pks`, querying them in batches of `batch_size`.
+
+    Returns a dictionary that maps each pk on its structure.
+    """
+    structures = {}
+
+    for start in range(0, len(pks), batch_size):
+        query = orm.QueryBuilder().append(
+            orm.StructureData,
+            filters={"id": {"in": pks[start : start + batch_size]}},
+            project=("id", "*"),
+        )
+        structures.update(query.iterall())
+
+    return structures
+
+
+def replace_structure(structure, replacement_structure):
+    """Replace a structure with a better duplicate by swapping their `duplicates` extras."""
     structure_source = "|".join(
         [
             structure.extras["source"]["database"],
@@ -102,16 +137,3 @@ def replace_structure(replacement, unique_group):
 
     replacement_structure.base.extras.set("duplicates", list(duplicates_set))
     structure.base.extras.delete("duplicates")
-
-    unique_group.backend_entity.add_nodes(
-        [
-            replacement_structure.backend_entity,
-        ],
-        skip_orm=True,
-    )
-    unique_group.backend_entity.remove_nodes(
-        [
-            structure.backend_entity,
-        ],
-        skip_orm=True,
-    )
@@ -1,96 +1,265 @@
 # -*- coding: utf-8 -*-
 """Utitilies for the uniqueness analysis."""
-import click
+import collections
+import contextlib
+import multiprocessing
+
 import spglib
-from aiida.tools.data.structure import structure_to_spglib_tuple
-from numpy import eye, where
-from rich.progress import Progress
-from scipy.sparse.csgraph import connected_components
+from numpy import array, linalg
+from rich.progress import track
 
+try:
+    import moyopy
+except ImportError:
+    moyopy = None
 
-def get_spglib_spacegroup_symbol(structure, symprec=0.005):
-    """Get the spacegroup symbol of a structure using spglib."""
-    return spglib.get_symmetry_dataset(
-        structure_to_spglib_tuple(structure)[0],
-        symprec=symprec,
-    )["international"]
 
+def get_spglib_cell(structure):
+    """Get the spglib cell of a `StructureData` from its attributes, assigning a separate number to each kind."""
+    attributes = structure.base.attributes
+    kind_numbers = {
+        kind["name"]: number
+        for number, kind in enumerate(attributes.get("kinds"), start=1)
+    }
+    sites = attributes.get("sites")
+    lattice = array(attributes.get("cell"))
+    positions = array([site["position"] for site in sites])
+
+    return (
+        lattice,
+        linalg.solve(lattice.T, positions.T).T,
+        [kind_numbers[site["kind_name"]] for site in sites],
+    )
 
-def first_come_first_serve(ordered, matcher):
-    """Perform a similarity analysis using the first-come-first-serve method."""
 
-    global_unique_dict = {}
+SYMMETRY_BACKENDS = ("spglib", "moyopy")
 
-    with Progress() as progress:
-        task = progress.add_task("Uniqueness analysis")
-        advance = 100 / len(ordered)
 
-        for key, data in ordered.items():
-            progress.update(
-                task, description=f"Find uniques: {key:<16}", advance=advance
+def get_spacegroup_number(cell, symprec=0.005, backend="spglib"):
+    """Get the spacegroup number of a spglib cell using the symmetry `backend`, either `spglib` or `moyopy`."""
+    if backend == "moyopy":
+        if moyopy is None:
+            raise ImportError(
+                "The `moyopy` symmetry backend requires the `moyopy` package to be installed."
             )
+        lattice, positions, numbers = cell
+        return moyopy.MoyoDataset(
+            moyopy.Cell(lattice.tolist(), positions.tolist(), list(numbers)),
+            symprec=symprec,
+        ).number
 
-            uniq_dict = {}
+    if backend == "spglib":
+        return spglib.get_symmetry_dataset(cell, symprec=symprec)["number"]
 
-            for uuid, structure in zip(*zip(*data)):
-                new_unique = True
+    raise ValueError(
+        f"Unknown symmetry backend `{backend}`, choose from: {SYMMETRY_BACKENDS}"
+    )
 
-                # Look for similarity, stop in case you've found it
-                for uniq_data in uniq_dict.values():
-                    if matcher.fit(
-                        structure.get_pymatgen(), uniq_data[0].get_pymatgen()
-                    ):
-                        new_unique = False
-                        uniq_data[1].append(uuid)
-                        break
 
-                if new_unique:
-                    uniq_dict[uuid] = (structure, [uuid])
+def _get_spacegroup_number(task):
+    """Get the spacegroup number of a spglib cell, returning the exception instead in case the analysis fails."""
+    cell, symprec, backend = task
+    try:
+        return get_spacegroup_number(cell, symprec, backend)
+    except Exception as exc:  # pylint: disable=broad-except
+        return exc
 
-            global_unique_dict.update(uniq_dict)
 
-    return global_unique_dict
+def get_spacegroup_numbers(
+    cells,
+    symprec=0.005,
+    backend="spglib",
+    parallelize=None,
+    description="Symmetry analysis:",
+):
+    """Get the spacegroup numbers of a list of spglib cells using the symmetry `backend`.
 
+    If `parallelize` is specified, the cells are distributed over that number of processes. In case the analysis fails
+    for a cell, the exception is returned instead of the number, so the failure can be reported for that structure.
+    """
+    tasks = [(cell, symprec, backend) for cell in cells]
 
-def seb_knows_best(ordered, matcher):
-    """Perform a similarity analysis using the Seb-knows-best method."""
+    with contextlib.ExitStack() as stack:
+        if parallelize:
+            pool = stack.enter_context(multiprocessing.Pool(parallelize))
+            results = pool.imap(_get_spacegroup_number, tasks, chunksize=100)
+        else:
+            results = map(_get_spacegroup_number, tasks)
+
+        return list(track(results, total=len(tasks), description=description))
+
+
+def get_reduced_structure(structure, matcher):
+    """Get the reduced pymatgen `structure`, as `matcher.fit` would obtain it."""
+    # pylint: disable=protected-access
+    structure = matcher._process_species([structure])[0]
+    return matcher._get_reduced_structure(
+        structure, matcher._primitive_cell, niggli=True
+    )
+
+
+def requires_equal_sizes(matcher):
+    """Check if the `matcher` can only fit structures with the same number of sites.
+
+    Without primitive cell reduction, supercell or subset matching, `StructureMatcher.fit` can only find a mapping
+    between structures with the same number of sites, so pairs of different size can be skipped without a fit.
+    """
+    # pylint: disable=protected-access
+    return not (matcher._primitive_cell or matcher._supercell or matcher._subset)
+
+
+def find_root(parents, index):
+    """Find the root of `index` in the disjoint-set forest `parents`, compressing the path along the way."""
+    root = index
+    while parents[root] != root:
+        root = parents[root]
+
+    while parents[index] != root:
+        parents[index], index = root, parents[index]
+
+    return root
+
+
+def get_first_come_prototypes(structures, matcher):
+    """Get the prototypes of a list of pymatgen structures using the first-come-first-serve method."""
+    equal_sizes = requires_equal_sizes(matcher)
+    reduced = [get_reduced_structure(s, matcher) for s in structures]
+    prototypes = []
+
+    for index, structure in enumerate(reduced):
+        # Look for similarity, stop in case you've found it
+        for prototype in prototypes:
+            if equal_sizes and len(structure) != len(reduced[prototype[0]]):
+                continue
+            if matcher.fit(
+                structure, reduced[prototype[0]], skip_structure_reduction=True
+            ):
+                prototype.append(index)
+                break
+        else:
+            prototypes.append([index])
+
+    return prototypes
+
+
+def get_connected_prototypes(structures, matcher):
+    """Get the prototypes of a list of pymatgen structures using the Seb-knows-best method."""
+    equal_sizes = requires_equal_sizes(matcher)
+    reduced = [get_reduced_structure(s, matcher) for s in structures]
+
+    nstructures = len(structures)
+    parents = list(range(nstructures))
+
+    # Join the structures that match into the same set, i.e. the connected components of the match graph
+    for i in range(nstructures):
+        for j in range(i + 1, nstructures):
+            if equal_sizes and len(reduced[i]) != len(reduced[j]):
+                continue
+
+            root_i, root_j = find_root(parents, i), find_root(parents, j)
 
-    label = "Uniqueness analysis for each compound"
-    with click.progressbar(label=label, length=len(ordered), show_pos=True) as progress:
-        unique = {}
+            # Already connected through other matches, so the fit can't change the components
+            if root_i == root_j:
+                continue
 
-        for structures in ordered.values():
-            uuids = [s[0] for s in structures]
-            structures = [s[1] for s in structures]
+            if matcher.fit(reduced[i], reduced[j], skip_structure_reduction=True):
+                parents[root_j] = root_i
 
-            nstructures = len(structures)
-            adjacent_matrix = eye(nstructures, dtype=int)
+    prototype_indices = collections.defaultdict(list)
+    for index in range(nstructures):
+        prototype_indices[find_root(parents, index)].append(index)
 
-            for i in range(nstructures):
-                for j in range(i + 1, nstructures):
-                    adjacent_matrix[i, j] = matcher.fit(
-                        structures[i].get_pymatgen(), structures[j].get_pymatgen()
-                    )
-                    adjacent_matrix[j, i] = adjacent_matrix[i, j]
+    return list(prototype_indices.values())
 
-            _, connection = connected_components(adjacent_matrix, directed=False)
-            prototype_indices = [
-                where(connection == e)[0].tolist() for e in set(connection)
-            ]
 
-            for prototype in prototype_indices:
-                prototype_uuids = [uuids[index] for index in prototype]
-                prototype_structure = structures[prototype[0]]
+def get_pymatgen_prototypes(structures, matcher):
+    """Get the prototypes of a list of pymatgen structures using `StructureMatcher.group_structures`."""
+    indices = {id(structure): index for index, structure in enumerate(structures)}
 
-                unique[uuids[prototype[0]]] = (prototype_structure, prototype_uuids)
+    return [
+        [indices[id(structure)] for structure in group]
+        for group in matcher.group_structures(structures)
+    ]
 
-            progress.update(1)
+
+_MATCHER = None
+
+
+def _init_matcher(matcher):
+    """Set the `StructureMatcher` used by `_get_prototypes` in the current process."""
+    global _MATCHER  # pylint: disable=global-statement
+    _MATCHER = matcher
+
+
+def _get_prototypes(task):
+    """Unpack a task of `find_prototypes`, so it can be passed to `multiprocessing.Pool.imap_unordered`."""
+    key, get_prototypes, structures = task
+    return key, get_prototypes(structures, _MATCHER)
+
+
+def find_prototypes(ordered, matcher, get_prototypes, parallelize=None):
+    """Find the prototypes of the structures for each key in `ordered` using the `get_prototypes` method.
+
+    The `get_prototypes` method returns the prototypes as lists of structure indices, the first of which is the
+    prototype structure. If `parallelize` is specified, the keys are distributed over that number of processes. Since
+    the AiiDA nodes can't be sent to other processes, the tasks only contain the pymatgen structures.
+    """
+    unique = {}
+    tasks = []
+
+    for key, data in ordered.items():
+        # A single structure is its own prototype, so there is no need to convert it to pymatgen or send it off
+        if len(data) == 1:
+            uuid, structure = data[0]
+            unique[uuid] = (structure, [uuid])
+        else:
+            tasks.append(
+                (
+                    key,
+                    get_prototypes,
+                    [structure.get_pymatgen() for _, structure in data],
+                )
+            )
+
+    # Start with the largest tasks, so these don't end up holding up the pool at the end
+    tasks.sort(key=lambda task: len(task[2]), reverse=True)
+
+    with contextlib.ExitStack() as stack:
+        if parallelize:
+            pool = stack.enter_context(
+                multiprocessing.Pool(
+                    parallelize, initializer=_init_matcher, initargs=(matcher,)
+                )
+            )
+            results = pool.imap_unordered(_get_prototypes, tasks)
+        else:
+            _init_matcher(matcher)
+            results = map(_get_prototypes, tasks)
+
+        for key, prototypes in track(
+            results,
+            total=len(tasks),
+            description="Uniqueness analysis:" + " " * 10,
+        ):
+            data = ordered[key]
+
+            for prototype in prototypes:
+                uuid, structure = data[prototype[0]]
+                unique[uuid] = (structure, [data[index][0] for index in prototype])
 
     return unique
 
 
-def pymatgen_group(ordered, matcher):
-    """Perform a similarity analysis using the pymatgen method."""
-    structures = [s[1] for data in ordered.values() for s in data]
+def first_come_first_serve(ordered, matcher, parallelize=None):
+    """Perform a similarity analysis using the first-come-first-serve method."""
+    return find_prototypes(ordered, matcher, get_first_come_prototypes, parallelize)
 
-    return matcher.group_structures(structures)
+
+def seb_knows_best(ordered, matcher, parallelize=None):
+    """Perform a similarity analysis using the Seb-knows-best method."""
+    return find_prototypes(ordered, matcher, get_connected_prototypes, parallelize)
+
+
+def pymatgen_group(ordered, matcher, parallelize=None):
+    """Perform a similarity analysis using the pymatgen method."""
+    return find_prototypes(ordered, matcher, get_pymatgen_prototypes, parallelize)